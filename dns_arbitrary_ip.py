@@ -3,6 +3,7 @@
 from __future__ import annotations
 
 import argparse
+from functools import lru_cache
 from ipaddress import IPv4Address
 import logging
 
@@ -10,52 +11,56 @@ from server_common import DnsPerQuestionSimpleServer
 
 _LOGGER = logging.getLogger(__name__)
 
-def parse_english_number(in_english: str) -> int | None:
-    english_digits = in_english.split("-")
-    if len(english_digits) > 3:
-        return None
+ENGLISH_DIGITS = ["zero", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine"]
 
-    english_to_int = {"zero": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8, "nine": 9}
+def build_label_to_octet() -> dict[str, int]:
+    """Every label we accept for one IP octet, numeric or english, with up to 3 digits (so leading zeros work)."""
+    label_to_octet: dict[str, int] = {}
+    for num_digits in range(1, 4):
+        for num in range(min(10**num_digits, 0x100)):
+            digits = str(num).zfill(num_digits)
+            label_to_octet[digits] = num
+            label_to_octet["-".join(ENGLISH_DIGITS[int(digit)] for digit in digits)] = num
+    return label_to_octet
 
-    num = 0
-    for i, english_digit in enumerate(reversed(english_digits)):
-        digit = english_to_int.get(english_digit)
-        if digit is None:
-            return None
-        num += 10**i * digit
-    return num
+label_to_octet: dict[str, int] = build_label_to_octet()
 
 class DnsArbitraryIpServer(DnsPerQuestionSimpleServer):
+    # the answer only depends on the name asked about, so everyone can share cached responses
+    response_cache_size = 16384
+    response_cache_per_source = False
+
     def __init__(self, base_domain: list[str], reverse: bool) -> None:
         super().__init__(base_domain)
         self.reverse: bool = reverse
 
     def compute_simple_answer(self, query_domain: list[str], source_ip: IPv4Address, source_port: int) -> IPv4Address | None:
-        if len(query_domain) < 4:
-            _LOGGER.debug("Question name not long enough, skipping")
+        if len(query_domain) != 4:
+            _LOGGER.debug("Question name not the right length, skipping")
             return None
 
-        ip_labels = [qn.lower() for qn in query_domain] # notice the .lower()!
-        if self.reverse:
-            ip_labels.reverse()
-
-        ip_int_labels: list[int] = []
-        for label in ip_labels:
-            int_label: int | None
-            try:
-                int_label = int(label)
-            except ValueError:
-                int_label = parse_english_number(label)
-                if int_label is None:
-                    _LOGGER.debug(f"Question label was neither numeric nor english, skipping: '{label}'")
-                    return None
-
-            if not (0 <= int_label <= 0xFF):
-                _LOGGER.debug("Question contains an IP part out of the [0, 0xFF] range, skipping")
-                return None
-            ip_int_labels.append(int_label)
-
-        return IPv4Address(bytes(ip_int_labels))
+        return labels_to_ip(tuple(query_domain), self.reverse)
+
+@lru_cache(maxsize=4096)
+def labels_to_ip(query_labels: tuple[str, ...], reverse: bool) -> IPv4Address | None:
+    """
+    Pure function of the 4 (lowercased) IP labels, so repeat lookups of the same name (the common
+    case) are a cache hit.
+    """
+    if reverse:
+        query_labels = query_labels[::-1]
+
+    try:
+        a, b, c, d = [label_to_octet[label] for label in query_labels]
+    except KeyError:
+        # the table stops at 3 digits, but numbers with more leading zeros than that (0192) work too
+        try:
+            a, b, c, d = [label_to_octet[label.lstrip("0") or "0" if label.isdigit() else label] for label in query_labels]
+        except KeyError as e:
+            _LOGGER.debug("Question label was not a numeric or english number in the [0, 0xFF] range, skipping: '%s'", e.args[0])
+            return None
+    # the int constructor is IPv4Address's cheapest: no bytes object to build and no parsing to do
+    return IPv4Address((a << 24) | (b << 16) | (c << 8) | d)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -65,12 +70,16 @@ def main():
                         help="If set, then IPs will be reversed, eg 1.0.168.192.markasoftware.com would resolve to 192.168.0.1.")
     parser.add_argument("--listen-host", default="0.0.0.0")
     parser.add_argument("--listen-port", default="53")
+    parser.add_argument("--workers", default="1",
+                        help="Number of worker processes to answer queries with. They share the listening port via SO_REUSEPORT. 0 means one per CPU, each pinned to its own CPU.")
+    parser.add_argument("--busy-poll", default="0",
+                        help="Microseconds to busy poll the network card for queries before sleeping (SO_BUSY_POLL). Lowers latency at the cost of CPU; needs CAP_NET_ADMIN. 0 to disable.")
     args = parser.parse_args()
 
     base_domain = args.base_domain.split(".")
 
     server = DnsArbitraryIpServer(base_domain, args.reverse)
-    server.listen(host=args.listen_host, port=int(args.listen_port))
+    server.listen(host=args.listen_host, port=int(args.listen_port), workers=int(args.workers), busy_poll_usecs=int(args.busy_poll))
 
 if __name__ == "__main__":
     logging.basicConfig()
@@ -3,56 +3,85 @@
 from __future__ import annotations
 
 import argparse
+from collections import OrderedDict, deque
 from dataclasses import dataclass, field
 from ipaddress import IPv4Address
-from functools import lru_cache
 import logging
-import typing as ty
 
+from lib_dns import DnsResourceData, DnsResourceDataA
 from server_common import DnsPerQuestionSimpleServer
 
 _LOGGER = logging.getLogger(__name__)
 
+# how many subdomains to keep track of at once
+EPHEMERAL_DOMAINS_SIZE = 2048
+
 class DnsSwitcherooServer(DnsPerQuestionSimpleServer):
+    # Once a source has been told an IP for a subdomain, it keeps getting that same one, so its
+    # response can be cached. That only stops being true when a subdomain gets evicted below and
+    # starts over from scratch -- so every fresh EphemeralDomain bumps the cache generation.
+    response_cache_size = 16384
+    # which IP a source gets depends on who asked before it
+    single_worker_only = True
+
     def __init__(self, base_domain: list[str], ips: list[IPv4Address]) -> None:
         super().__init__(base_domain=base_domain)
-
-        @lru_cache(maxsize=2048)
-        def get_ephemeral_domain(domain: str) -> EphemeralDomain:
-            """A bit of a hack -- we abuse @lru_cache because we actually mutate the output. `domain` arg is only the label before the base domain."""
-            return EphemeralDomain(remaining_ips=[IPv4Address(ip) for ip in ips])
-
-        self.get_ephemeral_domain: ty.Callable[[str], EphemeralDomain] = get_ephemeral_domain
+        self.ips: tuple[IPv4Address, ...] = tuple(IPv4Address(ip) for ip in ips)
+        # subdomain label -> its state, least recently used first
+        self.ephemeral_domains: OrderedDict[str, EphemeralDomain] = OrderedDict()
+        # we only ever answer with one of `ips`, so each answer's record data is built exactly once
+        self.answer_data_by_ip: dict[int, DnsResourceData] = {int(ip): DnsResourceDataA(ip) for ip in self.ips}
+
+    def get_ephemeral_domain(self, domain: str) -> EphemeralDomain:
+        """
+        `domain` arg is only the label before the base domain. Only the most recently used
+        EPHEMERAL_DOMAINS_SIZE are remembered; older ones start over from scratch.
+        """
+        ephemeral_domain = self.ephemeral_domains.get(domain)
+        if ephemeral_domain is not None:
+            self.ephemeral_domains.move_to_end(domain)
+            return ephemeral_domain
+
+        self.response_cache_generation += 1
+        ephemeral_domain = EphemeralDomain(remaining_ips=deque(self.ips))
+        self.ephemeral_domains[domain] = ephemeral_domain
+        if len(self.ephemeral_domains) > EPHEMERAL_DOMAINS_SIZE:
+            self.ephemeral_domains.popitem(last=False)
+        return ephemeral_domain
+
+    def answer_data(self, ip: IPv4Address) -> DnsResourceData:
+        return self.answer_data_by_ip[int(ip)]
 
     def compute_simple_answer(self, query_domain: list[str], source_ip: IPv4Address, source_port: int) -> IPv4Address | None:
         if len(query_domain) != 1:
             _LOGGER.debug("Question name not the right length, skipping")
             return None
 
-        ephemeral_label = query_domain[0].lower() # notice the .lower()!
+        ephemeral_label = query_domain[0] # already lowercased
         ephemeral_domain = self.get_ephemeral_domain(ephemeral_label)
 
-        already_assigned_ip = ephemeral_domain.assigned_ips.get(source_ip)
+        # IPv4Address hashes by formatting itself as a hex string, in Python; the int is much cheaper to look up
+        source_ip_raw = int(source_ip)
+        already_assigned_ip = ephemeral_domain.assigned_ips.get(source_ip_raw)
         if already_assigned_ip:
-            _LOGGER.debug(f"IP already assigned for {source_ip} on subdomain {ephemeral_label}: {already_assigned_ip}")
+            _LOGGER.debug("IP already assigned for %s on subdomain %s: %s", source_ip, ephemeral_label, already_assigned_ip)
             return already_assigned_ip
 
         assert ephemeral_domain.remaining_ips, "ephemeral_domain.remaining_ips should never be empty"
 
         if len(ephemeral_domain.remaining_ips) == 1:
-            _LOGGER.debug(f"Only one IP left on subdomain {ephemeral_label} and source {source_ip} is unknown: {already_assigned_ip}")
+            _LOGGER.debug("Only one IP left on subdomain %s and source %s is unknown: %s", ephemeral_label, source_ip, ephemeral_domain.remaining_ips[0])
             return ephemeral_domain.remaining_ips[0]
 
-        result_ip = ephemeral_domain.remaining_ips[0]
-        ephemeral_domain.remaining_ips = ephemeral_domain.remaining_ips[1:]
-        ephemeral_domain.assigned_ips[source_ip] = result_ip
-        _LOGGER.debug(f"Source IP {source_ip} on subdomain {ephemeral_label} is now assigned to: {result_ip}")
+        result_ip = ephemeral_domain.remaining_ips.popleft()
+        ephemeral_domain.assigned_ips[source_ip_raw] = result_ip
+        _LOGGER.debug("Source IP %s on subdomain %s is now assigned to: %s", source_ip, ephemeral_label, result_ip)
         return result_ip
 
-@dataclass
+@dataclass(slots=True)
 class EphemeralDomain:
-    remaining_ips: list[IPv4Address]
-    assigned_ips: dict[IPv4Address, IPv4Address] = field(default_factory=dict)
+    remaining_ips: deque[IPv4Address]
+    assigned_ips: dict[int, IPv4Address] = field(default_factory=dict)  # keyed by source IP as an int
 
 def main():
     parser = argparse.ArgumentParser()
@@ -3,36 +3,171 @@
 from __future__ import annotations
 
 import argparse
+from collections import OrderedDict
+from functools import lru_cache
 from ipaddress import IPv4Address
 import logging
-import shutil
-import subprocess
+import secrets
+import socket
+import time
+import typing as ty
 
+from lib_dns import HEADER_SIZE, DnsMessage, DnsQuestion, DnsResource, DnsResourceDataA, DnsResourceDataDomainName, DnsResourceDataSoa, DnsResourceDataUnknown, OpCode, QueryResponse, RCode, ResourceClass, ResourceType
 from server_common import DnsPerQuestionSimpleServer
 
 _LOGGER = logging.getLogger(__name__)
 
-def check_dig_exists() -> None:
-    if shutil.which("dig") is None:
-        raise RuntimeError("Missing `dig` -- needed for this dns server")
+# how long to remember a lookup that came back with no records at all, so no TTL to go by
+NEGATIVE_CACHE_TTL = 60
+# and never remember one for longer than this, whatever its TTL says
+MAX_CACHE_TTL = 3600
 
-def reverse_dns_lookup(address: IPv4Address, public_dns_server: IPv4Address, public_dns_server_port: int) -> str:
-    # I don't think we actually need `+norrcomments` but it can't hurt
-    return subprocess.check_output(["dig", f"@{public_dns_server.exploded}", f"-p{public_dns_server_port}", "+nocomments", "+noquestion", "+nocmd", "+nostats", "+norrcomments", "-x", address.exploded, "PTR", "-x", address.exploded, "SOA"]).decode("ascii").lower()
+def format_domain_name(labels: list[str]) -> str:
+    return "".join(label + "." for label in labels) or "."
+
+def format_resource(resource: DnsResource) -> str:
+    """One line per record, roughly like dig prints it"""
+    try:
+        type_name = ResourceType(resource.r_type).name
+    except ValueError:
+        type_name = f"TYPE{resource.r_type}"
+    data = resource.data
+    if isinstance(data, DnsResourceDataA):
+        data_str = data.ip_addr.exploded
+    elif isinstance(data, DnsResourceDataDomainName):
+        data_str = format_domain_name(data.domain_name)
+    elif isinstance(data, DnsResourceDataSoa):
+        data_str = f"{format_domain_name(data.mname)} {format_domain_name(data.rname)} {data.serial} {data.refresh} {data.retry} {data.expire} {data.minimum}"
+    else:
+        assert isinstance(data, DnsResourceDataUnknown)
+        data_str = f"\\# {len(data.r_data)} {data.r_data.hex()}"
+    return f"{format_domain_name(resource.name)}\t{resource.ttl}\tIN\t{type_name}\t{data_str}"
+
+class ReverseDnsResolver:
+    """
+    Looks up the PTR and SOA records of IPs' reverse names on an upstream DNS server, right here in
+    the process, and remembers the results for their TTL. The PTR and SOA queries go out together.
+    """
+
+    def __init__(self, server: IPv4Address, port: int, timeout: float = 2.0, tries: int = 2, cache_size: int = 8192) -> None:
+        self.timeout: float = timeout
+        self.tries: int = tries
+        self.cache_size: int = cache_size
+        # int(address) -> (expiry according to time.monotonic(), lookup result)
+        self.cache: OrderedDict[int, tuple[float, str]] = OrderedDict()
+        self.server_address: tuple[str, int] = (server.exploded, port)
+
+    def lookup(self, address: IPv4Address) -> str:
+        """
+        The PTR and SOA records for the address's reverse name, one per line, lowercased. Raises
+        TimeoutError if the server doesn't answer.
+        """
+        now = time.monotonic()
+        cached = self.cache.get(int(address))
+        if cached is not None and cached[0] > now:
+            self.cache.move_to_end(int(address))
+            return cached[1]
+
+        responses = self.query(address.reverse_pointer.split("."), [ResourceType.PTR.value, ResourceType.SOA.value])
+        resources = [resource for response in responses for resource in response.answers + response.authorities + response.additionals]
+        result = "".join(format_resource(resource) + "\n" for resource in resources).lower()
+
+        ttl = min(min((resource.ttl for resource in resources), default=NEGATIVE_CACHE_TTL), MAX_CACHE_TTL)
+        self.cache[int(address)] = (now + ttl, result)
+        self.cache.move_to_end(int(address))
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    def query(self, name: list[str], q_types: list[int]) -> list[DnsMessage]:
+        """Ask one question per type about `name`, all at once, and return the responses in the same order."""
+        queries: dict[int, bytes] = {}
+        for q_type in q_types:
+            transaction_id = secrets.randbits(16)
+            while transaction_id in queries:
+                transaction_id = secrets.randbits(16)
+            queries[transaction_id] = DnsMessage(
+                transaction_id=transaction_id,
+                query_response=QueryResponse.QUERY,
+                opcode=OpCode.STANDARD_QUERY,
+                authoritative_answer=False,
+                truncation=False,
+                recursion_desired=True,
+                recursion_available=False,
+                z=0,
+                rcode=RCode.NO_ERROR,
+                questions=[DnsQuestion(name=name, q_type=q_type, q_class=ResourceClass.IN.value)],
+                answers=[],
+                authorities=[],
+                additionals=[],
+            ).serialize()
+        order = list(queries)
+        responses: dict[int, DnsMessage] = {}
+
+        # A fresh socket (so a fresh ephemeral port) per lookup, so an off-path attacker has to guess
+        # the port as well as the transaction ID. Connected, so the kernel drops anything that doesn't
+        # come from the server.
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(self.server_address)
+            for _ in range(self.tries):
+                for transaction_id, query_bytes in queries.items():
+                    if transaction_id not in responses:
+                        try:
+                            sock.send(query_bytes)
+                        except ConnectionRefusedError:
+                            # ICMP port unreachable from an earlier send, reported on this one instead
+                            pass
+                deadline = time.monotonic() + self.timeout / self.tries
+                while len(responses) < len(queries):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    sock.settimeout(remaining)
+                    try:
+                        data = sock.recv(4096)
+                    except socket.timeout:
+                        break
+                    except ConnectionRefusedError:
+                        # ICMP port unreachable from an earlier send; the retry might do better
+                        continue
+                    try:
+                        response = DnsMessage.parse(data)
+                    except Exception as e:
+                        _LOGGER.warning("Unparseable response from reverse DNS server: %s", e)
+                        continue
+                    # anything else is not an answer to one of our questions
+                    sent_query = queries.get(response.transaction_id)
+                    if sent_query is not None and response.query_response == QueryResponse.RESPONSE and data[HEADER_SIZE:len(sent_query)].lower() == sent_query[HEADER_SIZE:].lower():
+                        responses[response.transaction_id] = response
+                if len(responses) == len(queries):
+                    return [responses[transaction_id] for transaction_id in order]
+
+        raise TimeoutError(f"No response from reverse DNS server for {format_domain_name(name)}")
 
 class DnsTargetedSwitcherooServer(DnsPerQuestionSimpleServer):
     def __init__(self, base_domain: list[str], ip_mappings: list[tuple[str, IPv4Address]], fallback_ip: IPv4Address, public_dns_server: IPv4Address, public_dns_server_port: int) -> None:
         super().__init__(base_domain)
         self.ip_mappings: list[tuple[str, IPv4Address]] = ip_mappings
+        # ReverseDnsResolver.lookup lowercases its output, so lowercase the needles to match once, up front
+        self._lower_ip_mappings: list[tuple[str, IPv4Address]] = [(needle.lower(), ip) for needle, ip in ip_mappings]
         self.fallback_ip: IPv4Address = fallback_ip
         self.public_dns_server: IPv4Address = public_dns_server
         self.public_dns_server_port: int = public_dns_server_port
+        self.reverse_dns_resolver: ReverseDnsResolver = ReverseDnsResolver(public_dns_server, public_dns_server_port)
+        # The resolver hands back the very same string for as long as it has an address cached, so the
+        # scan over the mappings only has to happen once per lookup, not once per query
+        self.match_ip_mappings: ty.Callable[[str], IPv4Address] = lru_cache(maxsize=8192)(self._match_ip_mappings)
 
     def compute_simple_answer(self, query_domain: list[str], source_ip: IPv4Address, source_port: int) -> IPv4Address | None:
-        reverse_dns_str = reverse_dns_lookup(source_ip, self.public_dns_server, self.public_dns_server_port)
-        _LOGGER.debug(f"Reverse DNS lookup for {source_ip}:\n{reverse_dns_str}")
-        for needle, ip in self.ip_mappings:
-            if needle.lower() in reverse_dns_str:
+        reverse_dns_str = self.reverse_dns_resolver.lookup(source_ip)
+        _LOGGER.debug("Reverse DNS lookup for %s:\n%s", source_ip, reverse_dns_str)
+        return self.match_ip_mappings(reverse_dns_str)
+
+    def _match_ip_mappings(self, reverse_dns_str: str) -> IPv4Address:
+        # first mapping that matches wins. `in` is a C-level substring search, which at any realistic
+        # number of mappings beats a combined regex scan by a mile
+        for needle, ip in self._lower_ip_mappings:
+            if needle in reverse_dns_str:
                 return ip
         return self.fallback_ip
         
@@ -62,8 +197,6 @@ def main() -> None:
     public_dns_server = IPv4Address(args.public_dns_server)
     public_dns_server_port = int(args.public_dns_server_port)
 
-    check_dig_exists()
-
     server = DnsTargetedSwitcherooServer(base_domain=base_domain, ip_mappings=ip_mappings, fallback_ip=fallback_ip, public_dns_server=public_dns_server, public_dns_server_port=public_dns_server_port)
     server.listen(args.listen_host, int(args.listen_port))
 
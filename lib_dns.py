@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 import abc
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
+from functools import lru_cache
 from ipaddress import IPv4Address
 import logging
 import struct
@@ -32,21 +33,88 @@ class RCode(Enum):
     NOT_IMPLEMENTED = 4
     REFUSED = 5
 
+def decode_flags_byte_1(flags_byte_1: int) -> tuple[bool, bool, bool, OpCode, QueryResponse] | None:
+    """(recursion_desired, truncation, authoritative_answer, opcode, query_response), or None if the opcode is unknown"""
+    try:
+        opcode = OpCode((flags_byte_1 >> 3) & 0b1111)
+    except ValueError:
+        return None
+    return (
+        bool((flags_byte_1) & 0b1),
+        bool((flags_byte_1 >> 1) & 0b1),
+        bool((flags_byte_1 >> 2) & 0b1),
+        opcode,
+        QueryResponse((flags_byte_1 >> 7) & 0b1),
+    )
+
+def decode_flags_byte_2(flags_byte_2: int) -> tuple[RCode, int, bool] | None:
+    """(rcode, z, recursion_available), or None if the rcode is unknown"""
+    try:
+        rcode = RCode(flags_byte_2 & 0b1111)
+    except ValueError:
+        return None
+    z = (flags_byte_2 >> 4) & 0b111  # modern day Z contains AD bit and stuff, let's just ignore
+    return rcode, z, bool((flags_byte_2 >> 7) & 0b1)
+
+# Each flags byte only has 256 possible values, so decode them all up front and parsing becomes a
+# single index per byte instead of a pile of shifts, masks and Enum lookups.
+_FLAGS_BYTE_1_DECODED = tuple(decode_flags_byte_1(flags_byte_1) for flags_byte_1 in range(0x100))
+_FLAGS_BYTE_2_DECODED = tuple(decode_flags_byte_2(flags_byte_2) for flags_byte_2 in range(0x100))
+
+@lru_cache(maxsize=None)
+def encode_flags(recursion_desired: bool, truncation: bool, authoritative_answer: bool, opcode: OpCode, query_response: QueryResponse, rcode: RCode, z: int, recursion_available: bool) -> tuple[int, int]:
+    """Inverse of the decode_flags_byte_* functions. Cached, since we send the same few combinations over and over."""
+    flags_byte_1 = (int(recursion_desired) & 0b1) | \
+        ((int(truncation) & 0b1) << 1) | \
+        ((int(authoritative_answer) & 0b1) << 2) | \
+        ((opcode.value & 0b1111) << 3) | \
+        ((query_response.value & 0b1) << 7)
+    flags_byte_2 = (rcode.value & 0b1111) | \
+        ((z & 0b111) << 4) | \
+        ((int(recursion_available) & 0b1) << 7)
+    return flags_byte_1, flags_byte_2
+
 class ResourceType(Enum):
     A = 1
+    NS = 2
+    CNAME = 5
+    SOA = 6
+    PTR = 12
 
 class ResourceClass(Enum):
     IN = 1
 
 DomainName = list[str]  # labels
 
-@dataclass
+# EDNS pseudo-record (RFC 6891), which dig and most resolvers add to every query they send
+_OPT_R_TYPE = 41
+
+# compiled once, rather than re-parsing the format string on every struct.pack/unpack call
+_HEADER_STRUCT = struct.Struct("!HBBHHHH")
+_TYPE_CLASS_STRUCT = struct.Struct("!HH")
+_RESOURCE_HEADER_STRUCT = struct.Struct("!HHLH")
+# compression pointer to the owner name, immediately followed by the rest of the resource header
+_COMPRESSED_RESOURCE_HEADER_STRUCT = struct.Struct("!HHHLH")
+# serial, refresh, retry, expire, minimum
+_SOA_NUMBERS_STRUCT = struct.Struct("!LLLLL")
+
+# compression pointers only have 14 bits for the offset
+_MAX_COMPRESSION_OFFSET = 0x3FFF
+
+@dataclass(slots=True)
 class DnsQuestion:
     name: DomainName
     q_type: int
     q_class: int
-
-@dataclass
+    # `name` with ASCII letters lowercased (DNS names are case-insensitive, but responses need to echo
+    # the original case). Filled in by DnsMessage.parse; None if the question was made some other way.
+    lower_name: DomainName | None = field(default=None, compare=False, repr=False)
+    # `name` exactly as it appeared on the wire, if it wasn't compressed, so that echoing the question
+    # back in a response is a single copy instead of encoding it label by label all over again. Filled
+    # in by DnsMessage.parse; if you change `name` on a parsed question, reset this to None!
+    name_wire: bytes | None = field(default=None, compare=False, repr=False)
+
+@dataclass(slots=True)
 class DnsResource:
     # the r_ prefixes are not standard, but to avoid "type" and "class" python reserved words
     name: DomainName
@@ -56,41 +124,181 @@ class DnsResource:
     data: DnsResourceData
 
 class DnsResourceData(abc.ABC):
+    __slots__ = ()  # so the slotted dataclass subclasses really don't get a __dict__
+
     @abc.abstractmethod
     def to_bytes(self) -> bytes:
         ...
 
-@dataclass
+@dataclass(slots=True)
 class DnsResourceDataUnknown(DnsResourceData):
     r_data: bytes
 
     @staticmethod
-    def try_from_bytes(r_type: int, r_class: int, msg: bytes) -> DnsResourceDataUnknown:
-        return DnsResourceDataUnknown(msg)
+    def try_from_bytes(r_type: int, r_class: int, r_data: bytes, msg: bytes, text: str, r_data_start: int) -> DnsResourceDataUnknown:
+        return DnsResourceDataUnknown(r_data)
 
     def to_bytes(self) -> bytes:
         return self.r_data
 
-@dataclass
+@dataclass(slots=True)
 class DnsResourceDataA(DnsResourceData):
     ip_addr: IPv4Address
+    # wire format of `ip_addr`, worked out once up front; servers that keep answering with the same
+    # few addresses can hold on to their DnsResourceDataA objects and never compute it again
+    packed: bytes = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        self.packed = self.ip_addr.packed
+
+    @staticmethod
+    def try_from_bytes(r_type: int, r_class: int, r_data: bytes, msg: bytes, text: str, r_data_start: int) -> DnsResourceDataA | None:
+        if r_type != ResourceType.A.value or r_class != ResourceClass.IN.value:
+            return None
+
+        if len(r_data) != 4:
+            raise DnsFormatError(f"Length of A record data must be 4 bytes exactly, but was {len(r_data)}")
+        return DnsResourceDataA(IPv4Address(r_data))
+
+    def to_bytes(self) -> bytes:
+        return self.packed
+
+def _parse_r_data_domain_name(msg: bytes, text: str, p: int, r_data_end: int) -> tuple[DomainName, int]:
+    """
+    A domain name inside resource data, which may be compressed against the rest of the message.
+    `text` is `msg` decoded as latin-1.
+    """
+    if p >= r_data_end:
+        raise DnsFormatError("Resource data ends before domain name")
+    labels, p, _ = _parse_domain_name(msg, text, p)
+    if p > r_data_end:
+        raise DnsFormatError("Domain name runs past the end of resource data")
+    return labels, p
+
+_DOMAIN_NAME_R_TYPES = {ResourceType.NS.value, ResourceType.CNAME.value, ResourceType.PTR.value}
+
+@dataclass(slots=True)
+class DnsResourceDataDomainName(DnsResourceData):
+    """Data of the record types that are just a single domain name: NS, CNAME and PTR"""
+    domain_name: DomainName
 
     @staticmethod
-    def try_from_bytes(r_type: int, r_class: int, msg: bytes) -> DnsResourceDataA | None:
-        if r_type != ResourceType.A.value or r_type != ResourceClass.IN.value:
+    def try_from_bytes(r_type: int, r_class: int, r_data: bytes, msg: bytes, text: str, r_data_start: int) -> DnsResourceDataDomainName | None:
+        if r_type not in _DOMAIN_NAME_R_TYPES:
             return None
 
-        if len(msg) != 4:
-            raise DnsFormatError(f"Length of A record data must be 4 bytes exactly, but was {len(msg)}")
-        ip_bytes = struct.unpack("4s", msg)
-        return DnsResourceDataA(IPv4Address(ip_bytes))
+        domain_name, _ = _parse_r_data_domain_name(msg, text, r_data_start, r_data_start + len(r_data))
+        return DnsResourceDataDomainName(domain_name)
 
     def to_bytes(self) -> bytes:
-        return struct.pack("4s", self.ip_addr.packed)
+        return encode_domain_name(self.domain_name)
+
+@dataclass(slots=True)
+class DnsResourceDataSoa(DnsResourceData):
+    mname: DomainName
+    rname: DomainName
+    serial: int
+    refresh: int
+    retry: int
+    expire: int
+    minimum: int
 
-dns_resource_data_classes = [DnsResourceDataA, DnsResourceDataUnknown]
+    @staticmethod
+    def try_from_bytes(r_type: int, r_class: int, r_data: bytes, msg: bytes, text: str, r_data_start: int) -> DnsResourceDataSoa | None:
+        if r_type != ResourceType.SOA.value:
+            return None
+
+        r_data_end = r_data_start + len(r_data)
+        mname, p = _parse_r_data_domain_name(msg, text, r_data_start, r_data_end)
+        rname, p = _parse_r_data_domain_name(msg, text, p, r_data_end)
+        if r_data_end - p != _SOA_NUMBERS_STRUCT.size:
+            raise DnsFormatError(f"SOA record has {r_data_end - p} bytes after its names, should be {_SOA_NUMBERS_STRUCT.size}")
+        return DnsResourceDataSoa(mname, rname, *_SOA_NUMBERS_STRUCT.unpack_from(msg, p))
 
-@dataclass
+    def to_bytes(self) -> bytes:
+        return encode_domain_name(self.mname) + encode_domain_name(self.rname) + _SOA_NUMBERS_STRUCT.pack(self.serial, self.refresh, self.retry, self.expire, self.minimum)
+
+# (r_type, r_class) -> the class that knows how to parse that kind of resource data. Anything not in
+# here (or that the class turns down) ends up as DnsResourceDataUnknown.
+dns_resource_data_classes: dict[tuple[int, int], type[DnsResourceData]] = {
+    (ResourceType.A.value, ResourceClass.IN.value): DnsResourceDataA,
+    (ResourceType.NS.value, ResourceClass.IN.value): DnsResourceDataDomainName,
+    (ResourceType.CNAME.value, ResourceClass.IN.value): DnsResourceDataDomainName,
+    (ResourceType.PTR.value, ResourceClass.IN.value): DnsResourceDataDomainName,
+    (ResourceType.SOA.value, ResourceClass.IN.value): DnsResourceDataSoa,
+}
+
+# The parse helpers live out here rather than nested inside DnsMessage.parse, so that a parse doesn't
+# have to build fresh closures (and their cells) every time, and the hot loops read locals instead.
+def _parse_domain_name(msg: bytes, text: str, p: int) -> tuple[DomainName, int, bool]:
+    """
+    Parse the domain name starting at offset p of `msg`, return it, the offset just past it, and
+    whether it was compressed. `text` is `msg` decoded as latin-1.
+    """
+    return _parse_domain_name_lowered(msg, text, text, p, None)
+
+def _parse_domain_name_lowered(msg: bytes, text: str, lower_text: str, p: int, lower_labels: list[str] | None) -> tuple[DomainName, int, bool]:
+    """
+    Like _parse_domain_name, but `lower_text` is `msg` lowercased, then decoded as latin-1, and the
+    lowercased labels get appended to `lower_labels` (if it's not None).
+    """
+    labels = []
+    # once we follow a compression pointer, the name ends (in the original position) right
+    # after the pointer, no matter how much further the pointed-to name goes
+    end_p: int | None = None
+    # compression pointers have to point strictly backwards, to a "prior occurrence" of the name
+    # (RFC 1035 4.1.4). That's what every real encoder does, and it means following them always
+    # terminates without having to remember where we've already been.
+    pointer_limit = p
+
+    try:
+        label_length = msg[p]
+        p += 1
+        while label_length != 0:
+            if (label_length >> 6) == 0b11:
+                pointer_p = p - 1
+                p = ((label_length & 0b111111) << 8) | msg[p]
+                if p >= pointer_limit:
+                    raise DnsFormatError(f"Compression pointer at {pointer_p} does not point backwards")
+                if end_p is None:
+                    end_p = pointer_p + 2
+                pointer_limit = p
+            elif (label_length >> 6) != 0b00:
+                # 0b01 and 0b10 are the obsolete extended/binary label types, not 64-191 byte labels
+                raise DnsFormatError(f"Unsupported label type {label_length >> 6:#04b}")
+            else:
+                labels.append(text[p:p + label_length])
+                if lower_labels is not None:
+                    lower_labels.append(lower_text[p:p + label_length])
+                p += label_length
+            label_length = msg[p]
+            p += 1
+    except IndexError:
+        raise DnsFormatError("Message ends in the middle of a domain name") from None
+    if end_p is None:
+        return labels, p, False
+    return labels, end_p, True
+
+def _parse_resources(msg: bytes, text: str, how_many: int, p: int) -> tuple[list[DnsResource], int]:
+    resources = []
+    for i in range(how_many):
+        name, p, _ = _parse_domain_name(msg, text, p)
+        r_type, r_class, ttl, r_dlength = _RESOURCE_HEADER_STRUCT.unpack_from(msg, p)
+        p += _RESOURCE_HEADER_STRUCT.size
+
+        r_data = msg[p:p + r_dlength]
+        p += r_dlength
+        dns_resource_data_class = dns_resource_data_classes.get((r_type, r_class))
+        downcasted_data = None
+        if dns_resource_data_class is not None:
+            downcasted_data = dns_resource_data_class.try_from_bytes(r_type, r_class, r_data, msg, text, p - r_dlength) # type: ignore[attr-defined]
+        if downcasted_data is None:
+            downcasted_data = DnsResourceDataUnknown(r_data)
+
+        resources.append(DnsResource(name=name, r_type=r_type, r_class=r_class, ttl=ttl, data=downcasted_data))
+    return resources, p
+
+@dataclass(slots=True)
 class DnsMessage:
     transaction_id: int
     query_response: QueryResponse
@@ -107,84 +315,55 @@ class DnsMessage:
     additionals: list[DnsResource]
 
     @staticmethod
-    def parse(orig_msg: bytes) -> DnsMessage:
-        msg = orig_msg
-
-        def bsplit(msg: bytes, at: int) -> tuple[bytes, bytes]:
-            return msg[:at], msg[at:]
-
-        def bsplit_1(msg: bytes) -> tuple[int, bytes]:
-            return msg[0], msg[1:]
-
-        def parse_domain_name(msg: bytes) -> tuple[DomainName, bytes]:
-            """Parse the domain name starting at buf, return it and the unparsed bytes"""
-            labels = []
-
-            label_length, msg = bsplit_1(msg)
-            while label_length != 0:
-                _LOGGER.debug(f"Label length: {label_length}")
-                # dns compression: can refer to any location in the message
-                if (label_length >> 6) == 0b11:
-                    _LOGGER.debug("Compressed domain name!")
-                    label_length_2, msg = bsplit_1(msg)
-                    offset = ((label_length & 0b111111) << 8) + label_length_2
-                    pointed_to_domain_name, _ = parse_domain_name(orig_msg[offset:])
-                    labels += pointed_to_domain_name
-                    # an offset must be the last entry in a domain, so we're done
-                    return labels, msg
-
-                label_body, msg = bsplit(msg, label_length)
-                labels.append(label_body.decode('ascii'))
-                label_length, msg = bsplit_1(msg)
-            return labels, msg
-
-        if len(msg) < 12:
-            raise DnsFormatError("Message too short")
-        header, msg = bsplit(msg, 12)
-        transaction_id, flags_byte_1, flags_byte_2, question_count, answer_count, authority_count, additional_count = struct.unpack("!HBBHHHH", header)
-        recursion_desired = bool((flags_byte_1) & 0b1)
-        truncation = bool((flags_byte_1 >> 1) & 0b1)
-        authoritative_answer = bool((flags_byte_1 >> 2) & 0b1)
-        opcode = OpCode((flags_byte_1 >> 3) & 0b1111)
-        query_response = QueryResponse((flags_byte_1 >> 7) & 0b1)
+    def parse(msg: bytes) -> DnsMessage:
+        # Everything below walks `msg` with an integer cursor rather than repeatedly slicing off the
+        # parsed prefix, so no intermediate bytes objects get allocated along the way.
 
-        rcode = RCode(flags_byte_2 & 0b1111)
-        z = (flags_byte_2 >> 4) & 0b111  # modern day Z contains AD bit and stuff, let's just ignore
-        recursion_available = bool((flags_byte_2 >> 7) & 0b1)
+        # Decode the whole message once: latin-1 maps each byte to exactly one character, so offsets
+        # into `text` line up with offsets into `msg` and each label is just a slice of it.
+        text = msg.decode("latin-1")
+        # ...and lowercase it all in one C call, rather than calling .lower() on every label later
+        lower_text = msg.lower().decode("latin-1")
 
-        _LOGGER.debug("parsing questions")
+        if len(msg) < _HEADER_STRUCT.size:
+            raise DnsFormatError("Message too short")
+        transaction_id, flags_byte_1, flags_byte_2, question_count, answer_count, authority_count, additional_count = _HEADER_STRUCT.unpack_from(msg, 0)
+        p = _HEADER_STRUCT.size
+        flags_1 = _FLAGS_BYTE_1_DECODED[flags_byte_1]
+        if flags_1 is None:
+            raise DnsNotImplementedError(f"Unknown opcode {(flags_byte_1 >> 3) & 0b1111}")
+        recursion_desired, truncation, authoritative_answer, opcode, query_response = flags_1
+
+        flags_2 = _FLAGS_BYTE_2_DECODED[flags_byte_2]
+        if flags_2 is None:
+            raise DnsNotImplementedError(f"Unknown rcode {flags_byte_2 & 0b1111}")
+        rcode, z, recursion_available = flags_2
+
+        # checked once per message, rather than having each of these calls work it out again
+        debug = _LOGGER.isEnabledFor(logging.DEBUG)
+        if debug:
+            _LOGGER.debug("parsing questions")
         questions = []
         for i in range(question_count):
-            name, msg = parse_domain_name(msg)
-
-            typeclass, msg = bsplit(msg, 4)
-            q_type, q_class = struct.unpack("!HH", typeclass)
-
-            questions.append(DnsQuestion(name=name, q_type=q_type, q_class=q_class))
-
-        def parse_resources(how_many: int, msg: bytes) -> tuple[list[DnsResource], bytes]:
-            resources = []
-            for i in range(how_many):
-                name, msg = parse_domain_name(msg)
-                header, msg = bsplit(msg, 10)
-                r_type, r_class, ttl, r_dlength = struct.unpack("!HHLH", header)
-
-                r_data, msg = bsplit(msg, r_dlength)
-                for dns_resource_data_class in dns_resource_data_classes:
-                    downcasted_data = dns_resource_data_class.try_from_bytes(r_type, r_class, r_data) # type: ignore[attr-defined]
-                    if downcasted_data:
-                        break
-                assert downcasted_data
-
-                resources.append(DnsResource(name=name, r_type=r_type, r_class=r_class, ttl=ttl, data=downcasted_data))
-            return resources, msg
-
-        _LOGGER.debug("parsing answers")
-        answers, msg = parse_resources(answer_count, msg)
-        _LOGGER.debug("parsing authorities")
-        authorities, msg = parse_resources(authority_count, msg)
-        _LOGGER.debug("parsing additionals")
-        additionals, msg = parse_resources(additional_count, msg)
+            lower_name: DomainName = []
+            name_start = p
+            name, p, compressed = _parse_domain_name_lowered(msg, text, lower_text, p, lower_name)
+            name_wire = None if compressed else msg[name_start:p]
+
+            q_type, q_class = _TYPE_CLASS_STRUCT.unpack_from(msg, p)
+            p += _TYPE_CLASS_STRUCT.size
+
+            questions.append(DnsQuestion(name=name, q_type=q_type, q_class=q_class, lower_name=lower_name, name_wire=name_wire))
+
+        if debug:
+            _LOGGER.debug("parsing answers")
+        answers, p = _parse_resources(msg, text, answer_count, p)
+        if debug:
+            _LOGGER.debug("parsing authorities")
+        authorities, p = _parse_resources(msg, text, authority_count, p)
+        if debug:
+            _LOGGER.debug("parsing additionals")
+        additionals, p = _parse_resources(msg, text, additional_count, p)
 
         return DnsMessage(
             transaction_id=transaction_id,
@@ -203,48 +382,133 @@ class DnsMessage:
         )
 
     def serialize(self) -> bytes:
-        msg = bytes()
-
-        flags_byte_1 = (int(self.recursion_desired) & 0b1) | \
-            ((int(self.truncation) & 0b1) << 1) | \
-            ((int(self.authoritative_answer) & 0b1) << 2) | \
-            ((self.opcode.value & 0b1111) << 3) | \
-            ((self.query_response.value & 0b1) << 7)
-        flags_byte_2 = (self.rcode.value & 0b1111) | \
-            ((self.z & 0b111) << 4) | \
-            ((int(self.recursion_available) & 0b1) << 7)
-        msg += struct.pack("!HBBHHHH", self.transaction_id, flags_byte_1, flags_byte_2, len(self.questions), len(self.answers), len(self.authorities), len(self.additionals))
-
-        def serialize_domain_name(labels: list[str]) -> bytes:
-            result = bytes()
-            for label in labels:
-                result += struct.pack("B", len(label))
-                result += label.encode("ascii")
-            result += struct.pack("B", 0)
-            return result
-
-        for question in self.questions:
-           msg += serialize_domain_name(question.name)
-           msg += struct.pack("!HH", question.q_type, question.q_class)
-
-        def serialize_resources(resources: list[DnsResource]) -> bytes:
-            msg = bytes()
-            for resource in resources:
-                data_bytes = resource.data.to_bytes()
-
-                msg += serialize_domain_name(resource.name)
-                msg += struct.pack("!HHLH", resource.r_type, resource.r_class, resource.ttl, len(data_bytes))
-                msg += resource.data.to_bytes()
-            return msg
+        # One growing buffer for the whole message; `bytes +=` would copy everything written so far
+        # on every single field.
+        msg = bytearray(_HEADER_STRUCT.size)
 
-        msg += serialize_resources(self.answers)
-        msg += serialize_resources(self.authorities)
-        msg += serialize_resources(self.additionals)
+        flags_byte_1, flags_byte_2 = encode_flags(self.recursion_desired, self.truncation, self.authoritative_answer, self.opcode, self.query_response, self.rcode, self.z, self.recursion_available)
+        _HEADER_STRUCT.pack_into(msg, 0, self.transaction_id, flags_byte_1, flags_byte_2, len(self.questions), len(self.answers), len(self.authorities), len(self.additionals))
 
-        return msg
-
-def domains_equal(domain_1: list[str], domain_2: list[str]) -> bool:
-    return [dn1.lower() for dn1 in domain_1] == [dn2.lower() for dn2 in domain_2]
+        # (name, offset) of each question name, so that resources about the same name (ie, all our
+        # answers) can be written as a 2 byte compression pointer instead of the whole name again
+        question_name_offsets: list[tuple[DomainName, int]] = []
+        for question in self.questions:
+           # (the root name is a single byte, shorter than the pointer would be)
+           if question.name and len(msg) <= _MAX_COMPRESSION_OFFSET:
+               question_name_offsets.append((question.name, len(msg)))
+           if question.name_wire is not None:
+               msg.extend(question.name_wire)
+           else:
+               msg.extend(encode_domain_name(question.name))
+           msg.extend(_TYPE_CLASS_STRUCT.pack(question.q_type, question.q_class))
+
+        _serialize_resources(msg, self.answers, question_name_offsets)
+        _serialize_resources(msg, self.authorities, question_name_offsets)
+        _serialize_resources(msg, self.additionals, question_name_offsets)
+
+        return bytes(msg)
+
+def _serialize_resources(msg: bytearray, resources: list[DnsResource], question_name_offsets: list[tuple[DomainName, int]]) -> None:
+    """Append `resources` to `msg`, pointing back at an already written question name where possible."""
+    for resource in resources:
+        data_bytes = resource.data.to_bytes()
+
+        for question_name, offset in question_name_offsets:
+            if resource.name is question_name or resource.name == question_name:
+                msg.extend(_COMPRESSED_RESOURCE_HEADER_STRUCT.pack(0b11 << 14 | offset, resource.r_type, resource.r_class, resource.ttl, len(data_bytes)))
+                break
+        else:
+            msg.extend(encode_domain_name(resource.name))
+            msg.extend(_RESOURCE_HEADER_STRUCT.pack(resource.r_type, resource.r_class, resource.ttl, len(data_bytes)))
+        msg.extend(data_bytes)
+
+HEADER_SIZE = _HEADER_STRUCT.size
+
+def find_single_question(msg: bytes) -> tuple[int, int] | None:
+    """
+    Cheaply check, without a full parse, whether `msg` is a standard query with exactly one question
+    whose name is not compressed, followed by nothing but (optionally) one EDNS OPT record. If so,
+    return (name_end, question_end): the name is msg[HEADER_SIZE:name_end], and the whole question
+    including type and class is msg[HEADER_SIZE:question_end]. Otherwise, return None.
+    """
+    if len(msg) < HEADER_SIZE:
+        return None
+    _, flags_byte_1, flags_byte_2, question_count, answer_count, authority_count, additional_count = _HEADER_STRUCT.unpack_from(msg, 0)
+    if question_count != 1 or answer_count != 0 or authority_count != 0 or additional_count > 1:
+        return None
+    if (flags_byte_1 >> 3) & 0b1111 != OpCode.STANDARD_QUERY.value:
+        return None
+    # an rcode we don't know makes the full parser fail, so the fast path mustn't answer it either
+    if _FLAGS_BYTE_2_DECODED[flags_byte_2] is None:
+        return None
+
+    p = HEADER_SIZE
+    while True:
+        if p >= len(msg):
+            return None
+        label_length = msg[p]
+        p += 1
+        if label_length == 0:
+            break
+        if label_length > 0b111111:
+            # compression pointer or some weird label type; leave it for the full parser
+            return None
+        p += label_length
 
-def domain_label_equal(label_1: str, label_2: str) -> bool:
-    return label_1.lower() == label_2.lower()
+    question_end = p + _TYPE_CLASS_STRUCT.size
+    if additional_count == 0:
+        # anything trailing might be what makes the full parser turn the message down
+        if question_end != len(msg):
+            return None
+    else:
+        # an OPT record has the root as its name, and its data has to run exactly to the end
+        opt_data_start = question_end + 1 + _RESOURCE_HEADER_STRUCT.size
+        if opt_data_start > len(msg) or msg[question_end] != 0:
+            return None
+        r_type, _, _, r_dlength = _RESOURCE_HEADER_STRUCT.unpack_from(msg, question_end + 1)
+        if r_type != _OPT_R_TYPE or opt_data_start + r_dlength != len(msg):
+            return None
+    return p, question_end
+
+def raw_name_ends_with(msg: bytes, name_start: int, name_end: int, suffix_wire: bytes) -> bool:
+    """
+    Whether the uncompressed name at msg[name_start:name_end] ends with the labels of `suffix_wire`
+    (a lowercase name in wire format, see `encode_domain_name`), ignoring case.
+    """
+    suffix_start = name_end - len(suffix_wire)
+    if suffix_start < name_start or msg[suffix_start:name_end].lower() != suffix_wire:
+        return False
+    # the bytes match, but that might just be because the suffix started in the middle of a label
+    p = name_start
+    while p < suffix_start:
+        p += 1 + msg[p]
+    return p == suffix_start
+
+def serialize_echo_response(query: bytes, question_end: int, response_header: bytes) -> bytes:
+    """
+    A response to a query vetted by `find_single_question`, made by patching the query's transaction
+    ID into an already-serialized `response_header` (whose question count must be 1) and copying the
+    question straight over from the query bytes.
+    """
+    return query[:2] + response_header[2:HEADER_SIZE] + query[HEADER_SIZE:question_end]
+
+# a compression pointer to the question name right after the header, then the rest of an A/IN answer
+_SINGLE_A_ANSWER_STRUCT = struct.Struct("!HHHLH4s")
+_SINGLE_A_ANSWER_NAME_POINTER = 0b11 << 14 | HEADER_SIZE
+_TYPE_A = ResourceType.A.value
+_CLASS_IN = ResourceClass.IN.value
+
+def serialize_single_a_response(response_header: bytes, transaction_id: int, question: bytes, ttl: int, ip_packed: bytes) -> bytes:
+    """
+    Straight-line version of DnsMessage.serialize for the one response shape we send all the time: a
+    single question (`question` is its wire format, uncompressed, non-root name) and a single A/IN
+    answer for that same name. `response_header` is an already-serialized header with one question
+    and one answer, and its transaction ID gets replaced.
+    """
+    return transaction_id.to_bytes(2, "big") + response_header[2:HEADER_SIZE] + question + _SINGLE_A_ANSWER_STRUCT.pack(_SINGLE_A_ANSWER_NAME_POINTER, _TYPE_A, _CLASS_IN, ttl, 4, ip_packed)
+
+def encode_domain_name(labels: list[str]) -> bytes:
+    """Wire format of a domain name, without compression"""
+    # latin-1 maps characters 0-255 straight to bytes, so the length prefixes can ride along as
+    # characters and the whole name gets encoded in one call instead of one per label
+    return ("".join([chr(len(label)) + label for label in labels]) + "\0").encode("latin-1")
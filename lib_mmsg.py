@@ -0,0 +1,151 @@
+"""
+Receive and send batches of UDP datagrams with one recvmmsg(2)/sendmmsg(2) syscall each. The socket
+module doesn't expose these, so we go through ctypes. Linux-only; use `MmsgSocket.is_supported()`
+to check before using it.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import errno
+from ipaddress import IPv4Address
+import logging
+import os
+import socket
+import sys
+
+_LOGGER = logging.getLogger(__name__)
+
+MSG_WAITFORONE = 0x10000
+
+class _SockaddrIn(ctypes.Structure):
+    _fields_ = [
+        ("sin_family", ctypes.c_ushort),
+        ("sin_port", ctypes.c_uint16),  # network byte order
+        ("sin_addr", ctypes.c_uint32),  # network byte order
+        ("sin_zero", ctypes.c_char * 8),
+    ]
+
+class _Iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p),
+        ("iov_len", ctypes.c_size_t),
+    ]
+
+class _Msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p),
+        ("msg_namelen", ctypes.c_uint32),
+        ("msg_iov", ctypes.POINTER(_Iovec)),
+        ("msg_iovlen", ctypes.c_size_t),
+        ("msg_control", ctypes.c_void_p),
+        ("msg_controllen", ctypes.c_size_t),
+        ("msg_flags", ctypes.c_int),
+    ]
+
+class _Mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _Msghdr),
+        ("msg_len", ctypes.c_uint),
+    ]
+
+def _load_libc() -> ctypes.CDLL | None:
+    # the structures above are laid out the way Linux has them; other systems (FreeBSD, say) export
+    # recvmmsg/sendmmsg too, but with different field sizes, so they'd get garbage
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_Mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_Mmsghdr), ctypes.c_uint, ctypes.c_int]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_LIBC = _load_libc()
+
+class MmsgSocket:
+    """
+    Wraps a bound AF_INET UDP socket. All the C structures are allocated once up front and reused for
+    every batch.
+    """
+
+    @staticmethod
+    def is_supported() -> bool:
+        return _LIBC is not None
+
+    def __init__(self, sock: socket.socket, batch_size: int = 64, max_datagram_size: int = 512) -> None:
+        assert _LIBC is not None, "recvmmsg/sendmmsg not available on this platform"
+        self._libc: ctypes.CDLL = _LIBC
+        self.sock: socket.socket = sock
+        self.batch_size: int = batch_size
+        self.max_datagram_size: int = max_datagram_size
+
+        self._recv_bufs = (ctypes.c_char * (max_datagram_size * batch_size))()
+        self._recv_names = (_SockaddrIn * batch_size)()
+        self._recv_iovecs = (_Iovec * batch_size)()
+        self._recv_msgs = (_Mmsghdr * batch_size)()
+        bufs_address = ctypes.addressof(self._recv_bufs)
+        for i in range(batch_size):
+            self._recv_iovecs[i].iov_base = bufs_address + i * max_datagram_size
+            self._recv_iovecs[i].iov_len = max_datagram_size
+            self._recv_msgs[i].msg_hdr.msg_name = ctypes.addressof(self._recv_names[i])
+            self._recv_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._recv_iovecs[i])
+            self._recv_msgs[i].msg_hdr.msg_iovlen = 1
+
+        self._send_iovecs = (_Iovec * batch_size)()
+        self._send_msgs = (_Mmsghdr * batch_size)()
+        for i in range(batch_size):
+            self._send_msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+            self._send_msgs[i].msg_hdr.msg_iov = ctypes.pointer(self._send_iovecs[i])
+            self._send_msgs[i].msg_hdr.msg_iovlen = 1
+
+    def recv(self) -> list[tuple[bytes, IPv4Address, int]]:
+        """Block until at least one datagram arrives, then return (data, source_ip, source_port) for up to batch_size of them."""
+        for i in range(self.batch_size):
+            # the kernel overwrites this with the actual address length, so reset it every time
+            self._recv_msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(_SockaddrIn)
+
+        while True:
+            num_received = self._libc.recvmmsg(self.sock.fileno(), self._recv_msgs, self.batch_size, MSG_WAITFORONE, None)
+            if num_received >= 0:
+                break
+            err = ctypes.get_errno()
+            if err != errno.EINTR:
+                raise OSError(err, os.strerror(err))
+
+        bufs_address = ctypes.addressof(self._recv_bufs)
+        datagrams = []
+        for i in range(num_received):
+            name = self._recv_names[i]
+            datagrams.append((
+                ctypes.string_at(bufs_address + i * self.max_datagram_size, self._recv_msgs[i].msg_len),
+                IPv4Address(socket.ntohl(name.sin_addr)),
+                socket.ntohs(name.sin_port),
+            ))
+        return datagrams
+
+    def send(self, responses: list[tuple[int, bytes]]) -> None:
+        """
+        Send each (i, data) in `responses` back to whoever sent the i-th datagram returned by the
+        most recent `recv`.
+        """
+        for j, (i, data) in enumerate(responses):
+            # c_char_p points straight at the bytes object's buffer; `responses` keeps it alive
+            self._send_iovecs[j].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p)
+            self._send_iovecs[j].iov_len = len(data)
+            self._send_msgs[j].msg_hdr.msg_name = ctypes.addressof(self._recv_names[i])
+
+        num_sent = 0
+        while num_sent < len(responses):
+            result = self._libc.sendmmsg(self.sock.fileno(), ctypes.byref(self._send_msgs[num_sent]), len(responses) - num_sent, 0)
+            if result >= 0:
+                num_sent += result
+                continue
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            # the first remaining message failed on its own (eg, unreachable address); skip it so one
+            # bad client can't keep the rest of the batch from being answered
+            _LOGGER.warning("Failed to send response: %s", os.strerror(err))
+            num_sent += 1
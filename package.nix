@@ -4,7 +4,6 @@
 
   dig,
   dnsmasq,
-  makeWrapper,
   python3,
   which,
   fetchFromGitHub,
@@ -14,17 +13,13 @@ stdenv.mkDerivation {
   name = "markasoftware-dns-pentesting";
   src = ./.;
 
-  nativeBuildInputs = [
-    makeWrapper
-  ];
-
   buildInputs = [
-    dig
     python3
     which
   ];
 
   checkInputs = [
+    dig
     dnsmasq
   ];
 
@@ -40,11 +35,4 @@ stdenv.mkDerivation {
         ln -s "$executable" "$out/bin/''${filename%.py}"
     done
   '';
-
-  # wrapProgram goes through symlinks :::|||
-  postFixup = ''
-    for executable in "$out"/dns_*; do
-        wrapProgram "$executable" --set PATH ${lib.makeBinPath [ dig ]}
-    done
-  '';
 }
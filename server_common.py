@@ -1,14 +1,86 @@
 import abc
+from collections import OrderedDict
 from ipaddress import IPv4Address
 import logging
+import os
+import signal
 import socket
+import sys
 
-from lib_dns import DnsFormatError, DnsMessage, DnsQuestion, DnsResource, DnsResourceDataA, OpCode, QueryResponse, RCode, ResourceClass, ResourceType, domains_equal
+from lib_dns import HEADER_SIZE, DnsMessage, DnsNotImplementedError, DnsQuestion, DnsResource, DnsResourceData, DnsResourceDataA, OpCode, QueryResponse, RCode, ResourceClass, ResourceType, encode_domain_name, find_single_question, raw_name_ends_with, serialize_echo_response, serialize_single_a_response
+from lib_mmsg import MmsgSocket
 
 _LOGGER = logging.getLogger(__name__)
 
+# Enum `.value` is a property lookup each time; these get checked for every single question
+_TYPE_A: int = ResourceType.A.value
+_CLASS_IN: int = ResourceClass.IN.value
+# the type and class at the end of a raw A/IN question
+_A_IN_WIRE: bytes = _TYPE_A.to_bytes(2, "big") + _CLASS_IN.to_bytes(2, "big")
+
+# how many different question names DnsPerQuestionSimpleServer keeps response templates for
+RESPONSE_TEMPLATES_SIZE = 16384
+
+# A few MB of socket buffer lets a burst of queries queue up in the kernel while we're busy with the
+# previous batch, instead of being dropped
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+# Linux-only, and not exposed by the socket module. Unlike the plain options, these can go past
+# net.core.rmem_max/wmem_max, but need CAP_NET_ADMIN
+_SO_RCVBUFFORCE = 33
+_SO_SNDBUFFORCE = 32
+# Also Linux-only and missing from the socket module
+_SO_BUSY_POLL = 46
+_SO_PREFER_BUSY_POLL = 69
+
+def set_socket_buffers(sock: socket.socket, size: int = SOCKET_BUFFER_SIZE) -> None:
+    """Grow the socket's receive and send buffers, as far as we're allowed to."""
+    for force_option, option in ((_SO_RCVBUFFORCE, socket.SO_RCVBUF), (_SO_SNDBUFFORCE, socket.SO_SNDBUF)):
+        # the option numbers mean something else entirely elsewhere (32 is SO_BROADCAST on macOS!)
+        if sys.platform.startswith("linux"):
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+                continue
+            except OSError:
+                pass  # not root; the kernel silently caps the plain option at the sysctl max instead
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+
+def set_busy_poll(sock: socket.socket, busy_poll_usecs: int) -> None:
+    """
+    Have blocking receives on the socket spin on the NIC's queue for up to this many microseconds
+    before going to sleep, trading CPU for latency. Needs CAP_NET_ADMIN, and Linux.
+    """
+    if not sys.platform.startswith("linux"):
+        _LOGGER.warning("Busy polling is only supported on Linux, not enabling it")
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, _SO_BUSY_POLL, busy_poll_usecs)
+    except OSError as e:
+        _LOGGER.warning("Could not enable busy polling: %s", e)
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, _SO_PREFER_BUSY_POLL, 1)
+    except OSError:
+        pass  # older than Linux 5.11; plain busy polling still works
+
 class DnsServer(abc.ABC):
-    """A DNS server that covers most common cases; subclasses implement `compute_response`. To use, call `serve`"""
+    """A DNS server that covers most common cases; subclasses implement `compute_response`. To use, call `listen`"""
+
+    # How many recent responses to remember, so that a repeat of a query (transaction ID aside) gets
+    # answered without parsing, compute_response or serializing. Off by default, because it's only
+    # correct for servers whose response is a pure function of the query bytes and, with
+    # `response_cache_per_source`, the source IP. Subclasses that turn it on must bump
+    # `response_cache_generation` whenever that function changes, eg because some state got reset.
+    response_cache_size: int = 0
+    response_cache_per_source: bool = True
+    # Set on servers whose responses depend on earlier queries. Each worker process would have its own
+    # copy of that state, and the kernel spreads a client's queries across workers, so such servers
+    # can only ever run one.
+    single_worker_only: bool = False
+
+    def __init__(self) -> None:
+        # (query minus transaction ID, source IP or None, generation) -> response
+        self.response_cache: OrderedDict[tuple[bytes, int | None, int], bytes] = OrderedDict()
+        self.response_cache_generation: int = 0
 
     def compute_error_response(self, query: DnsMessage, rcode: RCode) -> DnsMessage:
         """Optionally override to change the error response"""
@@ -29,37 +101,183 @@ class DnsServer(abc.ABC):
         )
 
 
+    def compute_unparseable_error_response(self, transaction_id: int, rcode: RCode) -> DnsMessage:
+        """Optionally override to change the error response to queries that couldn't even be parsed"""
+        return DnsMessage(
+            transaction_id=transaction_id,
+            query_response=QueryResponse.RESPONSE,
+            opcode=OpCode.STANDARD_QUERY,
+            authoritative_answer=False,
+            truncation=False,
+            recursion_desired=False,
+            recursion_available=False,
+            z=0,
+            rcode=rcode,
+            questions=[],
+            answers=[],
+            authorities=[],
+            additionals=[],
+        )
+
     @abc.abstractmethod
     def compute_response(self, query: DnsMessage, source_ip: IPv4Address, source_port: int) -> DnsMessage:
         ...
 
-    def listen(self, host: str, port: int) -> None:
+    def serialize_response(self, query: DnsMessage, response: DnsMessage) -> bytes:
+        """Optionally override with a faster way to serialize the responses compute_response makes"""
+        return response.serialize()
+
+    def prefilter(self, data: bytes) -> bytes | None:
+        """
+        Optionally override to answer a datagram straight from its raw bytes, skipping the full parse.
+        Return None to handle it the normal way instead. Whatever this returns must be exactly what the
+        normal way would have responded.
+        """
+        return None
+
+    def listen(self, host: str, port: int, workers: int = 1, busy_poll_usecs: int = 0) -> None:
+        """
+        Bind to host:port and serve forever. With workers > 1, fork that many worker processes, each
+        with its own SO_REUSEPORT socket on the same port so the kernel spreads incoming queries
+        across them. workers=0 means one per CPU we're allowed to run on. Only do that for servers
+        that don't keep any state between queries! busy_poll_usecs > 0 turns on busy polling, see
+        `set_busy_poll`.
+        """
         assert isinstance(port, int), "port must actually be an integer" # rookie mistake
+        assert workers >= 0, "can't have a negative number of workers"
+
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        if workers == 0:
+            workers = len(cpus) or os.cpu_count() or 1
+        assert workers == 1 or not self.single_worker_only, f"{type(self).__name__} keeps state between queries, so can't be split across workers"
+        # With a CPU to spare for each worker, pin worker i to the i-th CPU, and ask the kernel to
+        # prefer handing it the queries that arrived on that same CPU, so a query's cache lines never
+        # have to move between cores. With more workers than CPUs, let the scheduler sort it out.
+        worker_cpus: list[int | None] = list(cpus[:workers]) if 1 < workers <= len(cpus) else [None] * workers
 
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.bind((host, port))
+        socks = []
+        for cpu in worker_cpus:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            if workers > 1:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if cpu is not None and hasattr(socket, "SO_INCOMING_CPU"):
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_INCOMING_CPU, cpu)
+            set_socket_buffers(sock)
+            if busy_poll_usecs > 0:
+                set_busy_poll(sock, busy_poll_usecs)
+            sock.bind((host, port))
+            socks.append(sock)
 
-        print(f"Listening on {host}:{port}")
+        print(f"Listening on {host}:{port}" + (f" with {workers} workers" if workers > 1 else ""), flush=True)
+
+        if workers == 1:
+            self.serve(socks[0])
+            return
+
+        # turn SIGTERM into an exception so the `finally` below gets to clean up the workers
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        worker_pids = []
+        try:
+            for sock, cpu in zip(socks, worker_cpus):
+                pid = os.fork()
+                if pid == 0:
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    try:
+                        if cpu is not None:
+                            os.sched_setaffinity(0, {cpu})
+                        self.serve(sock)
+                    finally:
+                        os._exit(1)
+                worker_pids.append(pid)
+                sock.close()
+
+            # if any worker dies, take the rest down with it rather than limping along
+            pid, status = os.wait()
+            _LOGGER.error("Worker %s exited with status %s, shutting down", pid, status)
+        finally:
+            for pid in worker_pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def serve(self, sock: socket.socket) -> None:
+        """Answer queries arriving on an already-bound socket, forever."""
+        if MmsgSocket.is_supported():
+            self.serve_batched(MmsgSocket(sock))
+            return
 
         while True:
             try:
                 data, source_addr = sock.recvfrom(512)
-                source_ip = IPv4Address(source_addr[0])
-                source_port: int = source_addr[1]
+                # inet_aton + the int constructor is several times cheaper than IPv4Address parsing the string itself
+                source_ip = IPv4Address(int.from_bytes(socket.inet_aton(source_addr[0]), "big"))
+                response_bytes = self.handle_datagram(data, source_ip=source_ip, source_port=source_addr[1])
+                if response_bytes is not None:
+                    sock.sendto(response_bytes, source_addr)
+            except Exception as e:
+                _LOGGER.error("Error not handled gracefully! %s", e)
+
+    def serve_batched(self, mmsg_sock: MmsgSocket) -> None:
+        """Like `serve`, but receives and sends a whole batch of datagrams per syscall."""
+        while True:
+            responses: list[tuple[int, bytes]] = []
+            try:
+                datagrams = mmsg_sock.recv()
+            except Exception as e:
+                _LOGGER.error("Error not handled gracefully! %s", e)
+                continue
 
+            for i, (data, source_ip, source_port) in enumerate(datagrams):
                 try:
-                    query = DnsMessage.parse(data)
-                    response = self.compute_response(query, source_ip=source_ip, source_port=source_port)
-                except DnsFormatError as e:
-                    _LOGGER.warning(f"DNS format error: {e}")
-                    response = self.compute_error_response(query, rcode=RCode.FORMAT_ERROR)
+                    response_bytes = self.handle_datagram(data, source_ip=source_ip, source_port=source_port)
+                    if response_bytes is not None:
+                        responses.append((i, response_bytes))
                 except Exception as e:
-                    _LOGGER.warning(f"Error, sending error response: {e}")
-                    response = self.compute_error_response(query, rcode=RCode.SERVER_FAILURE)
+                    _LOGGER.error("Error not handled gracefully! %s", e)
 
-                sock.sendto(response.serialize(), source_addr)
+            try:
+                mmsg_sock.send(responses)
             except Exception as e:
-                _LOGGER.error(f"Error not handled gracefully! {e}")
+                _LOGGER.error("Error not handled gracefully! %s", e)
+
+    def handle_datagram(self, data: bytes, source_ip: IPv4Address, source_port: int) -> bytes | None:
+        """Turn one incoming query datagram into the response datagram, or None to not respond at all."""
+        response_bytes = self.prefilter(data)
+        if response_bytes is not None:
+            return response_bytes
+
+        if self.response_cache_size:
+            cache_source = int(source_ip) if self.response_cache_per_source else None
+            cached = self.response_cache.get((data[2:], cache_source, self.response_cache_generation))
+            if cached is not None:
+                self.response_cache.move_to_end((data[2:], cache_source, self.response_cache_generation))
+                return data[:2] + cached[2:]
+
+        try:
+            query = DnsMessage.parse(data)
+        except Exception as e:
+            if len(data) < 2:
+                _LOGGER.debug("Datagram too short to even have a transaction ID, dropping")
+                return None
+            _LOGGER.warning("DNS format error: %s", e)
+            # we don't have any questions to echo back, so this goes out with all zero section counts
+            rcode = RCode.NOT_IMPLEMENTED if isinstance(e, DnsNotImplementedError) else RCode.FORMAT_ERROR
+            return self.compute_unparseable_error_response(int.from_bytes(data[:2], "big"), rcode=rcode).serialize()
+
+        try:
+            response = self.compute_response(query, source_ip=source_ip, source_port=source_port)
+        except Exception as e:
+            _LOGGER.warning("Error, sending error response: %s", e)
+            return self.compute_error_response(query, rcode=RCode.SERVER_FAILURE).serialize()
+
+        response_bytes = self.serialize_response(query, response)
+        if self.response_cache_size:
+            # compute_response may have bumped the generation, and its response belongs to the new one
+            self.response_cache[(data[2:], cache_source, self.response_cache_generation)] = response_bytes
+            if len(self.response_cache) > self.response_cache_size:
+                self.response_cache.popitem(last=False)
+        return response_bytes
 
 class DnsPerQuestionServer(DnsServer, abc.ABC):
     """
@@ -79,7 +297,7 @@ class DnsPerQuestionServer(DnsServer, abc.ABC):
         ...
 
     def compute_response(self, query: DnsMessage, source_ip: IPv4Address, source_port: int) -> DnsMessage:
-        answers = [answer for answer in [self.compute_answer(q, source_ip, source_port) for q in query.questions] if answer is not None]
+        answers = [answer for q in query.questions if (answer := self.compute_answer(q, source_ip, source_port)) is not None]
 
         return DnsMessage(
             transaction_id = query.transaction_id,
@@ -100,29 +318,135 @@ class DnsPerQuestionServer(DnsServer, abc.ABC):
 class DnsPerQuestionSimpleServer(DnsPerQuestionServer, abc.ABC):
     """Like DnsPerQuestionServer, but only supports A records and also has a "base domain" that it checks that all requests are under."""
     def __init__(self, base_domain: list[str], ttl: int = 86400) -> None:
-        self.base_domain: list[str] = base_domain
+        super().__init__()
+        # lowercased once here so the per-question suffix check doesn't have to
+        self.base_domain: tuple[str, ...] = tuple(label.lower() for label in base_domain)
+        self._base_len: int = len(self.base_domain)
         self.ttl: int = ttl
+        # bytes.lower() only knows ASCII, so the raw prefilter can only be trusted for an ASCII base domain
+        self._base_suffix_wire: bytes | None = encode_domain_name(list(self.base_domain)) if all(label.isascii() for label in self.base_domain) else None
+        # Everything but the transaction ID of the header compute_response sends when nothing matched.
+        # Serialized once here; prefilter just patches in the transaction ID and question.
+        self._name_error_header: bytes = DnsMessage(
+            transaction_id = 0,
+            query_response = QueryResponse.RESPONSE,
+            opcode = OpCode.STANDARD_QUERY,
+            authoritative_answer = True,
+            truncation = False,
+            recursion_desired = False,
+            recursion_available = False,
+            z = 0,
+            rcode = RCode.NAME_ERROR,
+            questions = [DnsQuestion(name=[], q_type=0, q_class=0)],
+            answers = [],
+            authorities = [],
+            additionals = [],
+        ).serialize()[:HEADER_SIZE]
+        # Same again, for a response with one A answer
+        self._answer_header: bytes = DnsMessage(
+            transaction_id = 0,
+            query_response = QueryResponse.RESPONSE,
+            opcode = OpCode.STANDARD_QUERY,
+            authoritative_answer = True,
+            truncation = False,
+            recursion_desired = False,
+            recursion_available = False,
+            z = 0,
+            rcode = RCode.NO_ERROR,
+            questions = [DnsQuestion(name=[], q_type=0, q_class=0)],
+            answers = [DnsResource(name=[], r_type=_TYPE_A, r_class=_CLASS_IN, ttl=0, data=DnsResourceDataA(IPv4Address(0)))],
+            authorities = [],
+            additionals = [],
+        ).serialize()[:HEADER_SIZE]
+        # question name on the wire -> everything between the transaction ID and the answer's IP address
+        # in a response with a single A answer to it. That's all of it but 6 bytes, and those 6 are the
+        # only thing that changes between responses to the same question.
+        self._response_templates: dict[bytes, bytes] = {}
+
+    def prefilter(self, data: bytes) -> bytes | None:
+        """
+        Most junk traffic (scanners, other people's domains, AAAA/TXT/ANY lookups) isn't an A/IN question
+        under our base domain. Spot that from the raw question bytes and send NAME_ERROR right away,
+        exactly as compute_response would.
+        """
+        if self._base_suffix_wire is None:
+            return None
+        question = find_single_question(data)
+        if question is None:
+            return None
+        name_end, question_end = question
+        if data[question_end - 4:question_end] != _A_IN_WIRE:
+            _LOGGER.debug("Question is not A/IN, skipping")
+        elif not raw_name_ends_with(data, HEADER_SIZE, name_end, self._base_suffix_wire):
+            _LOGGER.debug("Question name is not under base domain, skipping")
+        else:
+            return None
+
+        return serialize_echo_response(data, question_end, self._name_error_header)
+
+    def serialize_response(self, query: DnsMessage, response: DnsMessage) -> bytes:
+        """
+        Responses with one A answer are served from `_response_templates`, or failing that
+        serialize_single_a_response; the rest get serialized normally.
+        """
+        if len(response.answers) != 1 or len(response.questions) != 1 or response.authorities or response.additionals:
+            return response.serialize()
+        question = response.questions[0]
+        answer = response.answers[0]
+        # only the exact shape compute_answer produces, so that the template really is interchangeable
+        if question.name_wire is None or not question.name or question.q_type != _TYPE_A or question.q_class != _CLASS_IN \
+                or answer.name is not question.name or answer.ttl != self.ttl or not isinstance(answer.data, DnsResourceDataA):
+            return response.serialize()
+
+        template = self._response_templates.get(question.name_wire)
+        if template is None:
+            response_bytes = serialize_single_a_response(self._answer_header, response.transaction_id, question.name_wire + _A_IN_WIRE, self.ttl, answer.data.packed)
+            if len(self._response_templates) >= RESPONSE_TEMPLATES_SIZE:
+                # question names are up to whoever sends them, so don't let this grow forever
+                self._response_templates.clear()
+            self._response_templates[question.name_wire] = response_bytes[2:-4]
+            return response_bytes
+        return response.transaction_id.to_bytes(2, "big") + template + answer.data.packed
+
+    def is_under_base_domain(self, lower_name: list[str]) -> bool:
+        """Walk the tail of the (already lowercased) name in place rather than slicing it."""
+        offset = len(lower_name) - self._base_len
+        if offset < 0:
+            return False
+        for i, base_label in enumerate(self.base_domain):
+            if lower_name[offset + i] != base_label:
+                return False
+        return True
+
+    def answer_data(self, ip: IPv4Address) -> DnsResourceData:
+        """
+        The A record data sent back for `ip`. Override to hand out prebuilt objects when there's only
+        a handful of possible answers, rather than allocating a fresh one for every response.
+        """
+        return DnsResourceDataA(ip)
 
     @abc.abstractmethod
     def compute_simple_answer(self, query_domain: list[str], source_ip: IPv4Address, source_port: int) -> IPv4Address | None:
+        """`query_domain` is the labels in front of the base domain, already lowercased."""
         ...
 
     def compute_answer(self, question: DnsQuestion, source_ip: IPv4Address, source_port: int) -> DnsResource | None:
-        if question.q_type != ResourceType.A.value or question.q_class != ResourceClass.IN.value:
+        if question.q_type != _TYPE_A or question.q_class != _CLASS_IN:
             _LOGGER.debug("Question is not A/IN, skipping")
             return None
-        if not domains_equal(question.name[-len(self.base_domain):], self.base_domain):
+        lower_name = question.lower_name if question.lower_name is not None else [label.lower() for label in question.name]
+        if not self.is_under_base_domain(lower_name):
             _LOGGER.debug("Question name is not under base domain, skipping")
             return None
 
-        result_ip = self.compute_simple_answer(question.name[:-len(self.base_domain)], source_ip=source_ip, source_port=source_port)
+        result_ip = self.compute_simple_answer(lower_name[:len(lower_name) - self._base_len], source_ip=source_ip, source_port=source_port)
         if result_ip is None:
             return None
 
         return DnsResource(
             name=question.name,
-            r_type=ResourceType.A.value,
-            r_class=ResourceClass.IN.value,
+            r_type=_TYPE_A,
+            r_class=_CLASS_IN,
             ttl=self.ttl,
-            data=DnsResourceDataA(result_ip),
+            data=self.answer_data(result_ip),
         )
@@ -16,6 +16,13 @@ big_dig() {
     dig @127.0.0.1 -p "$listen_port" -q "$subdomain.$base_domain" -t A +short +timeout=1
 }
 
+# @param $1 the full domain name to query
+# @param $2 the query type
+# prints just the response status, eg NOERROR or NXDOMAIN
+dig_status() {
+    dig @127.0.0.1 -p "$listen_port" -q "$1" -t "$2" +noall +comments +timeout=1 | grep -o 'status: [A-Z]*' | cut -d ' ' -f 2
+}
+
 # @param $1 the message to fail with
 fail_msg() {
     echo "ASSERTION FAILED: $1"
@@ -25,9 +32,26 @@ fail_msg() {
 [[ $(big_dig 192.168.0.1) == 192.168.0.1 ]] || fail_msg "Couldn't do basic numeric query"
 [[ $(big_dig one-nine-two.168.zero.one) == 192.168.0.1 ]] || fail_msg "Couldn't do mixed english-number query"
 [[ $(big_dig OnE-NINE-two.168.zerO.oNe) == 192.168.0.1 ]] || fail_msg "Couldn't do mixed-case mixed english-number query"
+[[ $(big_dig 0192.00168.000.01) == 192.168.0.1 ]] || fail_msg "Couldn't do zero-padded numeric query"
 base_domain="${base_domain//a/A}"
 [[ $(big_dig 192.168.0.1) == 192.168.0.1 ]] || fail_msg "Couldn't do mixed-case base domain query"
 
+# anything that isn't an A query for a valid name under the base domain gets an empty NXDOMAIN
+[[ -z $(dig @127.0.0.1 -p "$listen_port" -q "192.168.0.1.$base_domain" -t AAAA +short +timeout=1) ]] || fail_msg "Got an answer to an AAAA query"
+[[ $(dig_status "192.168.0.1.$base_domain" AAAA) == NXDOMAIN ]] || fail_msg "AAAA query wasn't NXDOMAIN"
+[[ -z $(dig @127.0.0.1 -p "$listen_port" -q 192.168.0.1.example.com -t A +short +timeout=1) ]] || fail_msg "Got an answer for a name outside the base domain"
+[[ $(dig_status 192.168.0.1.example.com A) == NXDOMAIN ]] || fail_msg "Query outside the base domain wasn't NXDOMAIN"
+[[ -z $(big_dig 1.192.168.0.1) ]] || fail_msg "Got an answer for a name with more than 4 IP labels"
+[[ $(dig_status "1.192.168.0.1.$base_domain" A) == NXDOMAIN ]] || fail_msg "Name with more than 4 IP labels wasn't NXDOMAIN"
+
+# same server again, but spread across several worker processes
+listen_port=3554
+python3 dns_arbitrary_ip.py --base-domain "$base_domain" --listen-host 127.0.0.1 --listen-port "$listen_port" --workers 4 &
+sleep 1
+for i in $(seq 1 20); do
+    [[ $(big_dig "10.0.0.$i") == "10.0.0.$i" ]] || fail_msg "Couldn't do basic numeric query with multiple workers"
+done
+
 set +x
 echo
 echo All tests passed!